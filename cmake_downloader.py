@@ -1,99 +1,298 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import hashlib
+import io
+import json
 import platform
 import re
 import tarfile
-import tempfile
+import threading
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
 
 import requests
+from packaging.version import Version
 from packaging.version import parse as version_parse
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
+from urllib3.util.retry import Retry
+
+try:
+    # the optional ISA-L bindings decompress tarballs considerably faster than zlib
+    from isal.igzip import GzipFile  # type: ignore[import-not-found]
+except ImportError:
+    from gzip import GzipFile  # type: ignore[assignment]
 
 TIMEOUT_SECONDS = 10
+MAX_WORKERS = 16
+CHUNK_SIZE = 256 * 1024
+INDEX_CACHE_FILE = Path.home() / ".cache" / "cmake_downloader" / "index.json"
+# written into an extracted directory once its archive was unpacked completely; contains the URL and SHA-256 of the
+# archive
+COMPLETE_MARKER = ".cmake_downloader_complete"
+
+# links are taken from the href attributes of the index pages, because Apache may truncate long link texts
+FOLDER_REGEX = re.compile(r'<a href="v([0-9.]+)/"')
+TARBALL_REGEX = re.compile(r'<a href="(cmake-[0-9rc.]+-[^."]+(?:\.tar\.gz|\.zip))"')
+VERSION_REGEX = re.compile(r"cmake-([0-9.]+(?:-rc[0-9]+)?)")
+PLATFORM_REGEXES = {
+    "macos": re.compile(r"Darwin64|Darwin-x86_64|macos-universal"),
+    "linux": re.compile(r"Linux-x86_64|linux-x86_64"),
+    "windows": re.compile(r"win32-x86|win64-x64|windows-x86_64"),
+}
+# 64-bit Windows binaries are preferred over 32-bit ones
+PREFERRED_PLATFORM_REGEX = re.compile(r"win64-x64|windows-x86_64")
+
+# all requests go to cmake.org, so a single session keeps the connections alive and retries transient errors
 session = requests.Session()
 
 
+def mount_adapter(pool_size: int) -> None:
+    # every parallel job needs its own connection in the pool, otherwise connections are discarded and reopened
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+        ),
+    )
+
+
+mount_adapter(MAX_WORKERS)
+
+# cached index pages: URL -> {"etag": ..., "last_modified": ..., "body": ...}
+# cached archive sizes: URL -> {"content_length": ...}
+index_cache = {}  # type: Dict[str, Dict[str, str]]
+
+
+def load_index_cache() -> None:
+    with contextlib.suppress(OSError, ValueError):
+        index_cache.update(json.loads(INDEX_CACHE_FILE.read_text(encoding="utf-8")))
+
+
+def save_index_cache() -> None:
+    with contextlib.suppress(OSError):
+        INDEX_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        INDEX_CACHE_FILE.write_text(json.dumps(index_cache), encoding="utf-8")
+
+
+def get_index_page(url: str) -> str:
+    # only ask for the page if it changed since it was cached
+    entry = index_cache.get(url, {})
+    headers = {}
+    if "etag" in entry:
+        headers["If-None-Match"] = entry["etag"]
+    if "last_modified" in entry:
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url=url, headers=headers, timeout=TIMEOUT_SECONDS)
+    if response.status_code == requests.codes.not_modified and "body" in entry:
+        return entry["body"]
+
+    if response.ok and ("ETag" in response.headers or "Last-Modified" in response.headers):
+        entry = {"body": response.text}
+        if "ETag" in response.headers:
+            entry["etag"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            entry["last_modified"] = response.headers["Last-Modified"]
+        index_cache[url] = entry
+
+    return response.text
+
+
 def get_folders() -> List[str]:
-    html = session.get(url="https://cmake.org/files/", timeout=TIMEOUT_SECONDS).text
-    return list(re.findall(r">v([0-9.]+)", html))
+    html = get_index_page(url="https://cmake.org/files/")
+    return FOLDER_REGEX.findall(html)
 
 
 def get_tarball_urls_version(base_version: str) -> List[str]:
     url = f"https://cmake.org/files/v{base_version}/"
-    html = session.get(url=url, timeout=TIMEOUT_SECONDS).text
-    return sorted([url + filename for filename in re.findall(r">(cmake-[0-9rc.]+-[^.]+(?:\.tar\.gz|\.zip))", html)])
+    html = get_index_page(url=url)
+    return sorted(url + filename for filename in TARBALL_REGEX.findall(html))
 
 
 def get_tarball_urls() -> List[str]:
+    load_index_cache()
     folders = get_folders()
     result = []  # type: List[str]
 
     print("Retrieving URLs...")
-    for folder in tqdm(folders):
-        urls = get_tarball_urls_version(folder)
-        result += urls
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # map preserves the order of the folders
+        for urls in tqdm(executor.map(get_tarball_urls_version, folders), total=len(folders)):
+            result += urls
 
+    save_index_cache()
     return result
 
 
-def download_and_extract(url: str, path: Path) -> None:
-    # derive file directory name from URL
+class ResumedStream(io.RawIOBase):
+    """Reads the already downloaded part of an archive first and then continues with the remote stream, appending
+    everything read from the remote stream to the partial file. Everything read is hashed on the way."""
+
+    def __init__(self, partial: io.BufferedRandom, remote: BinaryIO):
+        self.partial = partial
+        self.remote = remote
+        self.digest = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        size = self.partial.readinto(buffer)
+        if size:
+            self.digest.update(buffer[:size])
+            return size
+
+        data = self.remote.read(len(buffer))
+        self.partial.write(data)
+        self.digest.update(data)
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def get_file_name(url: str) -> str:
     file_name_start_pos = url.rfind("/") + 1
-    file_name = url[file_name_start_pos:]
-    file_wo_ext = file_name.replace(".tar.gz", "").replace(".zip", "")
+    return url[file_name_start_pos:]
 
-    if not (path / file_wo_ext).exists():
-        response = session.get(url=url, timeout=TIMEOUT_SECONDS, stream=True)
-        response.raise_for_status()
-        file_size = int(response.headers["Content-Length"])
 
-        tmpdir = tempfile.TemporaryDirectory()
-        full_file_name = Path(tmpdir.name) / file_name
+def get_directory_name(url: str) -> str:
+    # the archives contain a single directory named like the archive
+    return get_file_name(url).replace(".tar.gz", "").replace(".zip", "")
 
-        progress = tqdm(total=file_size, unit="B", unit_scale=True, unit_divisor=1024)
-        with Path(full_file_name).open(mode="wb+") as f:
-            for data in response:
-                progress.update(len(data))
-                f.write(data)
-        progress.close()
 
-        if url.endswith(".zip"):
-            with zipfile.ZipFile(full_file_name, mode="r") as zip_ref:
-                zip_ref.extractall(path)
-        else:
-            with tarfile.open(full_file_name, mode="r:gz") as tar:
-                tar.extractall(path=path)
+def get_download_size(url: str) -> Optional[int]:
+    # the size is remembered, so it is only requested once per archive; it is only used for the progress bar, so a
+    # missing size is not an error
+    if "content_length" not in index_cache.get(url, {}):
+        response = session.head(url=url, timeout=TIMEOUT_SECONDS, allow_redirects=True)
+        if not response.ok or "Content-Length" not in response.headers:
+            return None
+        index_cache[url] = {"content_length": response.headers["Content-Length"]}
+    return int(index_cache[url]["content_length"])
+
+
+def is_extracted(url: str, path: Path) -> bool:
+    # an interrupted extraction leaves a directory without the marker, so the directory alone is not enough
+    return (path / get_directory_name(url) / COMPLETE_MARKER).is_file()
+
+
+def request_remainder(url: str, partial_file_name: Path) -> Tuple[int, BinaryIO]:
+    # returns the size of the already downloaded part and a stream with the rest of the archive
+    start = partial_file_name.stat().st_size if partial_file_name.exists() else 0
+
+    # a partial file with the size of the archive seen in an earlier run needs no request at all
+    if start and index_cache.get(url, {}).get("content_length") == str(start):
+        return start, io.BytesIO()
+
+    headers = {"Range": f"bytes={start}-"} if start else {}
+    response = session.get(url=url, headers=headers, timeout=TIMEOUT_SECONDS, stream=True)
 
+    if response.status_code == requests.codes.range_not_satisfiable:
+        # a range beyond the end only means a complete download if the partial file has exactly the archive's size
+        if response.headers.get("Content-Range", "").rpartition("/")[2] == str(start):
+            return start, io.BytesIO()
 
-def create_version_dict(os: str) -> Dict[str, str]:
+        partial_file_name.unlink()
+        index_cache.pop(url, None)
+        start = 0
+        response = session.get(url=url, timeout=TIMEOUT_SECONDS, stream=True)
+
+    response.raise_for_status()
+    if response.status_code != requests.codes.partial_content:
+        # the server ignored the range, so the download starts over
+        start = 0
+    if "Content-Length" in response.headers:
+        index_cache[url] = {"content_length": str(start + int(response.headers["Content-Length"]))}
+
+    # the raw stream is decoded so that a transfer encoding does not end up in the archive
+    response.raw.decode_content = True
+    return start, response.raw
+
+
+def extract_archive(url: str, path: Path, partial: io.BufferedRandom, remote: BinaryIO) -> str:
+    # returns the SHA-256 of the archive
+    resumed_stream = ResumedStream(partial=partial, remote=remote)
+    stream = io.BufferedReader(resumed_stream, CHUNK_SIZE)
+    if url.endswith(".zip"):
+        # zip files need to be seekable, so they are downloaded completely first
+        while stream.read(CHUNK_SIZE):
+            pass
+        with zipfile.ZipFile(partial, mode="r") as zip_ref:
+            zip_ref.extractall(path)
+    else:
+        # tarballs are extracted while they are downloaded
+        with GzipFile(fileobj=stream, mode="rb") as gz, tarfile.open(fileobj=gz, mode="r|") as tar:
+            tar.extractall(path=path)
+        # the end of the archive may not have been read yet, but it is part of the hash
+        while stream.read(CHUNK_SIZE):
+            pass
+
+    return resumed_stream.digest.hexdigest()
+
+
+def download_and_extract(url: str, path: Path, update_progress: Optional[Callable[[int], object]] = None) -> None:
+    if is_extracted(url, path):
+        return
+
+    # archives are kept while downloading so that an interrupted download can be resumed
+    partial_file_name = path / ".partial" / get_file_name(url)
+    partial_file_name.parent.mkdir(parents=True, exist_ok=True)
+    start, remote = request_remainder(url, partial_file_name)
+
+    if update_progress:
+        update_progress(start)
+        remote = CallbackIOWrapper(update_progress, remote, "read")  # type: ignore[assignment]
+
+    try:
+        with partial_file_name.open(mode="r+b" if start else "w+b") as partial:
+            digest = extract_archive(url, path, partial, remote)
+    except (OSError, EOFError, zlib.error, tarfile.TarError, zipfile.BadZipFile):
+        # a broken archive would fail the same way on every run, so it is downloaded again next time; network errors
+        # are raised by urllib3 and keep the partial file for resuming
+        with contextlib.suppress(FileNotFoundError):
+            partial_file_name.unlink()
+        index_cache.pop(url, None)
+        raise
+
+    marker = path / get_directory_name(url) / COMPLETE_MARKER
+    marker.parent.mkdir(exist_ok=True)
+    marker.write_text(f"{url}\n{digest}\n", encoding="utf-8")
+    partial_file_name.unlink()
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        message = f"{value} is not a positive number"
+        raise argparse.ArgumentTypeError(message)
+    return number
+
+
+def create_version_dict(os: str) -> Dict[Version, str]:
     tarball_urls = get_tarball_urls()
     result = {}
 
+    platform_regex = PLATFORM_REGEXES[os]
+
     for tarball_url in tarball_urls:
-        version = re.findall(r"cmake-(([0-9.]+)(-rc[0-9]+)?)", tarball_url)[0][0]
-
-        if (
-            (
-                os == "macos"
-                and ("Darwin64" in tarball_url or "Darwin-x86_64" in tarball_url or "macos-universal" in tarball_url)
-            )
-            or (os == "linux" and ("Linux-x86_64" in tarball_url or "linux-x86_64" in tarball_url))
-            or (
-                os == "windows"
-                and ("win32-x86" in tarball_url or "win64-x64" in tarball_url or "windows-x86_64" in tarball_url)
-            )
-        ) and (
-            version_parse(version).public not in result
-            or (
-                version_parse(version).public in result
-                and ("win64-x64" in tarball_url or "windows-x86_64" in tarball_url)
-            )
-        ):
-            result[version_parse(version).public] = tarball_url
+        if not platform_regex.search(tarball_url):
+            continue
+
+        match = VERSION_REGEX.search(tarball_url)
+        if not match:
+            continue
+        version = version_parse(match.group(1))
+
+        if version not in result or PREFERRED_PLATFORM_REGEX.search(tarball_url):
+            result[version] = tarball_url
 
     return result
 
@@ -141,36 +340,88 @@ if __name__ == "__main__":
         default="tools",
         help='path to the CMake binaries (default: "tools")',
     )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=4,
+        help="number of parallel downloads (default: 4)",
+    )
     args = parser.parse_args()
+    mount_adapter(max(MAX_WORKERS, args.jobs))
 
     version_dict = create_version_dict(os=args.os)
-    versions = sorted([version_parse(version) for version in version_dict])
+    versions = sorted(version_dict)
     print(f"Found {len(versions)} versions from {versions[0]} to {versions[-1]}.")
 
+    # all filters keep the order, so the versions are only sorted once
     if args.min_version:
-        versions = sorted([version for version in versions if version >= version_parse(args.min_version)])
+        min_version = version_parse(args.min_version)
+        versions = [version for version in versions if version >= min_version]
 
     if args.max_version:
-        versions = sorted([version for version in versions if version <= version_parse(args.max_version)])
+        max_version = version_parse(args.max_version)
+        versions = [version for version in versions if version <= max_version]
 
     if not args.release_candidates:
         versions = [version for version in versions if not version.is_prerelease]
 
     if args.latest_patch:
-        result = []
-        for major, minor in {(version.major, version.minor) for version in versions}:
-            result.append([version for version in versions if version.major == major and version.minor == minor][-1])
-        versions = sorted(result)
+        # versions are sorted, so the last version of each release wins and the releases stay in order
+        latest_patches = {}
+        for version in versions:
+            latest_patches[(version.major, version.minor)] = version
+        versions = list(latest_patches.values())
 
     if args.first_minor:
-        result = []
-        for major, minor in {(version.major, version.minor) for version in versions}:
-            result.append(next(version for version in versions if version.major == major and version.minor == minor))
-        versions = sorted(result)
+        # versions are sorted, so the first version of each release is kept and the releases stay in order
+        first_minors = {}
+        for version in versions:
+            if (version.major, version.minor) not in first_minors:
+                first_minors[(version.major, version.minor)] = version
+        versions = list(first_minors.values())
 
     if args.latest_release:
         versions = versions[-1:]
 
-    for idx, version in enumerate(versions):
-        print(f"Downloading CMake {version.public} ({idx+1}/{len(versions)})...")
-        download_and_extract(url=version_dict[version.public], path=Path(args.tools_directory))
+    # skip versions that were already extracted before any download is started
+    tools_directory = Path(args.tools_directory)
+    missing_versions = [version for version in versions if not is_extracted(version_dict[version], tools_directory)]
+    if len(missing_versions) < len(versions):
+        print(f"Skipping {len(versions) - len(missing_versions)} versions that were already downloaded.")
+    versions = missing_versions
+
+    if versions:
+        print(f"Downloading {len(versions)} versions using {args.jobs} parallel jobs...")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            sizes = list(executor.map(get_download_size, [version_dict[version] for version in versions]))
+        # the total stays unknown if any size is missing
+        total_size = None if None in sizes else sum(size for size in sizes if size is not None)
+
+        # all parallel downloads share a single progress bar
+        progress = tqdm(total=total_size, unit="B", unit_scale=True, unit_divisor=1024)
+        progress_lock = threading.Lock()
+
+        def update_progress(size: int) -> None:
+            with progress_lock:
+                progress.update(size)
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {
+                executor.submit(download_and_extract, version_dict[version], tools_directory, update_progress): version
+                for version in versions
+            }
+            try:
+                for idx, future in enumerate(as_completed(futures)):
+                    future.result()
+                    tqdm.write(f"Downloaded CMake {futures[future].public} ({idx+1}/{len(versions)})")
+            finally:
+                # on an error or Ctrl-C, the queued downloads must not delay the exit
+                for pending_future in futures:
+                    pending_future.cancel()
+        progress.close()
+
+    save_index_cache()
+
+    # the directory for partial downloads is only removed once all downloads are done, because parallel jobs share it
+    with contextlib.suppress(OSError):
+        (tools_directory / ".partial").rmdir()
@@ -1,36 +1,58 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
 import contextlib
-import math
+import hashlib
+import json
+import os
 import platform
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
+from queue import Queue
 from time import time
-from typing import List, NamedTuple, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
+from packaging.version import InvalidVersion, Version
 from packaging.version import parse as version_parse
 from termcolor import colored
 
+REQUIRED_VERSION_REGEX = re.compile(r"CMake ([^ ]+) or higher is required\.")
+ERROR_LOCATION_REGEX = re.compile(r"CMake Error at (.*):")
+ERROR_MESSAGE_REGEX = re.compile(r"CMake Error: ([^\n]+)")
+DECLARED_VERSION_REGEX = re.compile(r"^\s*cmake_minimum_required\s*\(\s*VERSION\s+([0-9]+(?:\.[0-9]+)*)", re.I | re.M)
+
+MAX_STDERR_SIZE = 64 * 1024
+
 
 class CMakeBinary(NamedTuple):
     version: str
     binary: Path
+    # parsed once when the binary is found, used for sorting and comparing
+    parsed_version: Version
 
 
 class ConfigureResult:
-    def __init__(self, return_code: int, stderr: str):
+    def __init__(self, return_code: int, stderr: str, *, cached: bool = False):
         self.success = return_code == 0  # type: bool
         self.proposed_version = None  # type: Optional[str]
-        self.reason = None  # type: Optional[str]
         self.stderr = stderr
+        self.cached = cached  # type: bool
 
+        # the proposed version is only used after failed runs
+        if not self.success:
+            self._parse_proposed_version(stderr)
+
+    def _parse_proposed_version(self, stderr: str) -> None:
         # try to read proposed minimal version from stderr output
-        try:
-            self.proposed_version = re.findall(r"CMake ([^ ]+) or higher is required.", stderr)[0]
+        match = REQUIRED_VERSION_REGEX.search(stderr)
+        if match:
+            self.proposed_version = match.group(1)
 
             # support ranges
             if ".." in self.proposed_version:
@@ -38,52 +60,282 @@ class ConfigureResult:
             # make sure all versions are major.minor.patch
             if self.proposed_version.count(".") == 1:
                 self.proposed_version += ".0"
-        except IndexError:
-            pass
 
+    @property
+    def reason(self) -> Optional[str]:
+        # only needed for display, so it is not parsed before it is shown
+        match = ERROR_LOCATION_REGEX.search(self.stderr) or ERROR_MESSAGE_REGEX.search(self.stderr)
+        return match.group(1) if match else None
+
+    @property
+    def parsed_proposed_version(self) -> Optional[Version]:
+        # the version is taken from free-form error output, so it may not be a valid version at all
+        if not self.proposed_version:
+            return None
         try:
-            self.reason = re.findall(r"CMake Error at (.*):", stderr)[0]
-        except IndexError:
-            try:
-                self.reason = re.findall(r"CMake Error: ([^\n]+)", stderr)[0]
-            except IndexError:
-                pass
+            return version_parse(self.proposed_version)
+        except InvalidVersion:
+            return None
+
+
+class ProbeCache:
+    """Configure results from earlier runs, stored in the tools directory. Results are only reused for the same CMake
+    binary, the same parameters, unchanged CMake files of the project, and the same compiler and CMake environment
+    variables. Only the results of the current project and environment are kept, so the file does not grow with every
+    change."""
+
+    def __init__(self, tools_dir: Path, cmake_parameters: List[str]):
+        self.filename = tools_dir / ".probe_cache.json"  # type: Path
+        self.project_hash = get_project_hash(cmake_parameters)  # type: str
+        self.environment_hash = get_environment_hash()  # type: str
+        self.entries = self.load()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        with contextlib.suppress(OSError, ValueError):
+            entries = json.loads(self.filename.read_text(encoding="utf-8"))
+            return {key: entry for key, entry in entries.items() if key.endswith(self.key_suffix())}
+        return {}
+
+    def key_suffix(self) -> str:
+        return f":{self.project_hash}:{self.environment_hash}"
+
+    def key(self, binary: Path) -> str:
+        return f"{binary}{self.key_suffix()}"
+
+    def get(self, binary: Path) -> Optional[ConfigureResult]:
+        entry = self.entries.get(self.key(binary))
+        return ConfigureResult(return_code=entry["return_code"], stderr=entry["stderr"], cached=True) if entry else None
+
+    def put(self, binary: Path, return_code: int, stderr: str) -> None:
+        self.entries[self.key(binary)] = {"return_code": return_code, "stderr": stderr}
+
+    def save(self) -> None:
+        # write to a temporary file first so that an interrupted run cannot leave a broken cache behind
+        with contextlib.suppress(OSError):
+            temp_filename = self.filename.with_suffix(".tmp")
+            temp_filename.write_text(json.dumps(self.entries), encoding="utf-8")
+            temp_filename.replace(self.filename)
+
+
+def get_source_dirs(cmake_parameters: List[str]) -> List[Path]:
+    # the source directory is given as a plain path, as -S<dir>, or as -S <dir>; a directory after -B is the build tree
+    source_dirs = []  # type: List[Path]
+    for previous, parameter in zip(["", *cmake_parameters], cmake_parameters):
+        source_dir = parameter[2:] if parameter.startswith("-S") else parameter
+        if previous != "-B" and source_dir and Path(source_dir).is_dir():
+            source_dirs.append(Path(source_dir))
+
+    return source_dirs
+
+
+def get_parameter_files(cmake_parameters: List[str]) -> List[Path]:
+    # files passed as -C <file>, -C<file>, or -D<var>=<file> (e.g., a toolchain file) are read by CMake as well
+    parameter_files = []  # type: List[Path]
+    for previous, parameter in zip(["", *cmake_parameters], cmake_parameters):
+        if previous == "-C":
+            value = parameter
+        elif parameter.startswith("-C"):
+            value = parameter[2:]
+        elif parameter.startswith("-D") and "=" in parameter:
+            value = parameter.split("=", 1)[1]
+        else:
+            continue
+
+        if value and Path(value).is_file():
+            parameter_files.append(Path(value))
+
+    return parameter_files
+
+
+def get_file_digest(filename: Path) -> bytes:
+    # an unreadable file must not stop the search, it just makes the hash differ
+    try:
+        return f"{filename}\0".encode() + hashlib.sha256(filename.read_bytes()).digest()
+    except OSError as error:
+        return f"{filename}\0OSError:{error.errno}\0".encode()
+
+
+def get_project_hash(cmake_parameters: List[str]) -> str:
+    # hash the parameters, the files they name, and the contents of all CMake files in the source directories; unlike
+    # modification times, the contents survive checkouts and touches
+    digest = hashlib.sha256()
+    for parameter in cmake_parameters:
+        digest.update(parameter.encode() + b"\0")
+
+    for filename in get_parameter_files(cmake_parameters):
+        digest.update(get_file_digest(filename))
+
+    for source_dir in get_source_dirs(cmake_parameters):
+        for root, dirs, files in os.walk(source_dir):
+            # build trees are regenerated by every build, so their CMake files would change the hash all the time
+            dirs[:] = sorted(
+                directory
+                for directory in dirs
+                if directory != "CMakeFiles" and not Path(root, directory, "CMakeCache.txt").exists()
+            )
+            for name in sorted(files):
+                filename = Path(root, name)
+                if (name == "CMakeLists.txt" or name.endswith(".cmake")) and filename.is_file():
+                    digest.update(get_file_digest(filename))
+
+    return digest.hexdigest()
+
+
+def get_environment_hash() -> str:
+    # the result of a configure run also depends on the compilers and tools CMake finds
+    digest = hashlib.sha256()
+    for name, value in sorted(os.environ.items()):
+        if name in {"PATH", "CC", "CXX"} or name.startswith("CMAKE_"):
+            digest.update(f"{name}={value}\0".encode())
+
+    return digest.hexdigest()
+
+
+def get_declared_version(cmake_parameters: List[str]) -> Optional[Version]:
+    # every version older than the one passed to cmake_minimum_required stops with an error, so it need not be probed;
+    # only the first call counts, because later ones may be inside if() blocks that do not run on this platform
+    for source_dir in get_source_dirs(cmake_parameters):
+        cmake_lists = source_dir / "CMakeLists.txt"
+        if not cmake_lists.is_file():
+            continue
+
+        try:
+            content = cmake_lists.read_text(encoding="utf-8", errors="replace")
+        except OSError:
+            continue
+
+        match = DECLARED_VERSION_REGEX.search(content)
+        if match:
+            return version_parse(match.group(1))
+
+    return None
 
 
 def get_cmake_binaries(tools_dir: Path) -> List[CMakeBinary]:
     start_time = time()
     binaries = []  # type: List[CMakeBinary]
-    if platform.system() == "Windows":
-        filenames = tools_dir.rglob("**/bin/cmake.exe")
-    else:
-        filenames = tools_dir.rglob("**/bin/cmake")
+    binary_name = "cmake.exe" if platform.system() == "Windows" else "cmake"
+
+    # the downloader extracts each version into its own directory, so only the first level needs to be listed
+    # entries of an absolute directory have absolute paths, so the binaries need no conversion
+    with contextlib.suppress(FileNotFoundError), os.scandir(tools_dir.absolute()) as entries:
+        for entry in entries:
+            if not entry.name.startswith("cmake-") or not entry.is_dir():
+                continue
+
+            # directory names look like cmake-3.10.0-Linux-x86_64
+            _, version, *platform_name = entry.name.split("-")
+            if not platform_name:
+                continue
+
+            filename = Path(entry.path, "bin", binary_name)
+            if not filename.is_file():
+                # macOS archives contain an application bundle
+                filename = next(Path(entry.path).glob(f"*.app/Contents/bin/{binary_name}"), filename)
+                if not filename.is_file():
+                    continue
 
-    for filename in filenames:
-        with contextlib.suppress(IndexError):
-            version = re.findall(r"cmake-([^-]+)-", str(filename))[0]
-            binaries.append(CMakeBinary(version, Path(filename).resolve()))
+            binaries.append(CMakeBinary(version, filename, version_parse(version)))
 
     print(f"Found {len(binaries)} CMake binaries from directory {tools_dir} in {time()-start_time:.2f} seconds\n")
-    return sorted(binaries, key=lambda x: version_parse(x.version))
+    return sorted(binaries, key=lambda x: x.parsed_version)
 
 
-def try_configure(binary: Path, cmake_parameters: List[str]) -> ConfigureResult:
-    tmpdir = tempfile.TemporaryDirectory()
+def run_cmake(binary: Path, cmake_parameters: List[str], build_dir: Path) -> Tuple[int, str]:
     proc = subprocess.Popen(
         [binary, *cmake_parameters, "-Wno-dev"],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.PIPE,
-        cwd=tmpdir.name,
+        cwd=build_dir,
     )
+
+    # only the beginning of stderr is kept, because CMake reports the errors first; the rest is still read so that a
+    # full pipe cannot block the process
+    stderr = ""
+    if proc.stderr:
+        stderr = proc.stderr.read(MAX_STDERR_SIZE).decode("utf-8", errors="replace")
+        truncated = False
+        while proc.stderr.read(MAX_STDERR_SIZE):
+            truncated = True
+        if truncated:
+            stderr += f"\n[stderr truncated after {MAX_STDERR_SIZE // 1024} KiB]\n"
     proc.wait()
 
-    return ConfigureResult(
-        return_code=proc.returncode,
-        stderr=proc.stderr.read().decode("utf-8") if proc.stderr else "",
-    )
+    return proc.returncode, stderr
+
+
+def try_configure(
+    binary: Path,
+    cmake_parameters: List[str],
+    build_dir: Path,
+    probe_cache: Optional[ProbeCache] = None,
+) -> ConfigureResult:
+    if probe_cache:
+        cached_result = probe_cache.get(binary)
+        if cached_result:
+            return cached_result
+
+    # build directories are reused, so they must not contain results from the previous probe
+    for entry in build_dir.iterdir():
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+    return_code, stderr = run_cmake(binary, cmake_parameters, build_dir)
+
+    if probe_cache:
+        probe_cache.put(binary, return_code=return_code, stderr=stderr)
+
+    return ConfigureResult(return_code=return_code, stderr=stderr)
 
 
-def binary_search(*, cmake_parameters: List[str], tools_dir: Path, error_output: bool) -> Optional[CMakeBinary]:
+def print_result(result: ConfigureResult, *, error_output: bool) -> None:
+    # results from the probe cache are marked, because they may predate changes to the environment
+    cached_note = colored(" (cached)", "blue") if result.cached else ""
+    if result.success:
+        print(colored("✔ works", "green") + cached_note)
+        return
+
+    print(colored("✘ error", "red") + cached_note)
+    if error_output:
+        lines = result.stderr.splitlines()
+    else:
+        reason = result.reason
+        lines = [reason] if reason else []
+
+    for line in lines:
+        print(colored(f"       {line}", "yellow"))
+
+
+def get_next_lower_idx(result: ConfigureResult, failed_idx: int, parsed_versions: List[Version]) -> int:
+    # the failed version and all versions below it are known to fail, so the lower bound only moves up
+    proposed_version = result.parsed_proposed_version
+    if not proposed_version:
+        return failed_idx + 1
+
+    # the proposed version may not be installed, so continue with the next newer one
+    proposed_idx = bisect.bisect_left(parsed_versions, proposed_version)
+    return max(proposed_idx, failed_idx + 1)
+
+
+def get_remaining_rounds(remaining_versions: int, probes: int) -> int:
+    # ceil(log(n) / log(probes + 1)) without floating point; for a single probe this is ceil(log2(n))
+    rounds = 0
+    covered_versions = 1
+    while covered_versions < remaining_versions:
+        covered_versions *= probes + 1
+        rounds += 1
+    return rounds
+
+
+def binary_search(
+    *,
+    cmake_parameters: List[str],
+    tools_dir: Path,
+    error_output: bool,
+    jobs: int,
+    probe_cache: Optional[ProbeCache],
+) -> Optional[CMakeBinary]:
     versions = get_cmake_binaries(tools_dir)  # type: List[CMakeBinary]
     cmake_versions = [len(cmake.version) for cmake in versions]
     if len(cmake_versions) == 0:
@@ -96,81 +348,147 @@ def binary_search(*, cmake_parameters: List[str], tools_dir: Path, error_output:
         sys.exit(1)
     longest_version_string = max(cmake_versions) + 1  # type: int
 
-    lower_idx = 0  # type: int
+    parsed_versions = [cmake.parsed_version for cmake in versions]  # type: List[Version]
+
+    declared_version = get_declared_version(cmake_parameters)
+    lower_idx = bisect.bisect_left(parsed_versions, declared_version) if declared_version else 0  # type: int
     upper_idx = len(versions) - 1  # type: int
+    if lower_idx > 0:
+        print(f"Skipping versions older than CMake {declared_version} required by CMakeLists.txt\n")
     last_success_idx = None  # type: Optional[int]
+    missing_version = None  # type: Optional[str]
 
     steps = 0  # type: int
 
-    while lower_idx <= upper_idx:
-        mid_idx = int((lower_idx + upper_idx) / 2)  # type: int
-        cmake_binary = versions[mid_idx]  # type: CMakeBinary
-
-        steps += 1
-        remaining_versions = upper_idx - lower_idx + 1  # type: int
-        remaining_steps = int(math.ceil(math.log2(remaining_versions)))  # type: int
+    with tempfile.TemporaryDirectory() as tmpdir, ThreadPoolExecutor(max_workers=jobs) as executor:
+        # every parallel probe gets its own build directory, which is reused in the following rounds
+        build_dirs = [Path(tmpdir, str(slot)) for slot in range(jobs)]  # type: List[Path]
+        for build_dir in build_dirs:
+            build_dir.mkdir()
+
+        while lower_idx <= upper_idx:
+            # probe several versions at once, splitting the range into probes + 1 parts; a single probe is the middle
+            remaining_versions = upper_idx - lower_idx + 1  # type: int
+            probes = min(jobs, remaining_versions)  # type: int
+            probe_indices = [
+                lower_idx + (probe + 1) * (remaining_versions + 1) // (probes + 1) - 1 for probe in range(probes)
+            ]  # type: List[int]
+            futures = [
+                executor.submit(
+                    try_configure,
+                    binary=versions[probe_idx].binary,
+                    cmake_parameters=cmake_parameters,
+                    probe_cache=probe_cache,
+                    build_dir=build_dir,
+                )
+                for probe_idx, build_dir in zip(probe_indices, build_dirs)
+            ]
+
+            steps += 1
+            remaining_steps = get_remaining_rounds(remaining_versions, probes)  # type: int
+
+            for probe_idx, future in zip(probe_indices, futures):
+                print(
+                    f"[{100.0 * (steps - 1) / (steps + remaining_steps):3.0f}%] "
+                    f"CMake {versions[probe_idx].version:{longest_version_string}}",
+                    end="",
+                    flush=True,
+                )
+
+                result = future.result()  # type: ConfigureResult
+                print_result(result, error_output=error_output)
+
+                if result.success:
+                    last_success_idx = probe_idx
+                    upper_idx = probe_idx - 1
+                    # the newer versions of this round cannot improve the result
+                    break
+
+                lower_idx = max(lower_idx, get_next_lower_idx(result, probe_idx, parsed_versions))
+                proposed_version = result.parsed_proposed_version
+                if proposed_version and proposed_version > parsed_versions[-1]:
+                    missing_version = result.proposed_version
+
+            # the build directories are reused in the next round
+            wait(futures)
+
+    # reported once, even if several probes of a round asked for the same version
+    if missing_version:
+        message = f"project requires CMake {missing_version}, which is newer than all found versions"
+        print(colored(f"       {message}", "red"))
 
-        print(
-            "[{progress:3.0f}%] CMake {cmake_version:{longest_version_string}}".format(
-                progress=100.0 * float(steps - 1) / (steps + remaining_steps),
-                cmake_version=cmake_binary.version,
-                longest_version_string=longest_version_string,
-            ),
-            end="",
-            flush=True,
-        )
+    return versions[last_success_idx] if last_success_idx is not None else None
 
-        result = try_configure(binary=cmake_binary.binary, cmake_parameters=cmake_parameters)  # type: ConfigureResult
 
-        if result.success:
-            print(colored("✔ works", "green"))
-            last_success_idx = mid_idx
-            upper_idx = mid_idx - 1
-        else:
-            print(colored("✘ error", "red"))
-            if error_output:
-                for line in result.stderr.splitlines():
-                    print(colored(f"       {line}", "yellow"))
-            elif result.reason:
-                print(colored(f"       {result.reason}", "yellow"))
-            proposed_binary = [x for x in versions if x.version == result.proposed_version]
-            lower_idx = versions.index(proposed_binary[0]) if len(proposed_binary) else mid_idx + 1
+def full_search(
+    *,
+    cmake_parameters: List[str],
+    tools_dir: Path,
+    error_output: bool,
+    jobs: int,
+    probe_cache: Optional[ProbeCache],
+) -> Optional[CMakeBinary]:
+    versions = get_cmake_binaries(tools_dir)  # type: List[CMakeBinary]
+    longest_version_string = max(len(cmake.version) for cmake in versions) + 1  # type: int
+    last_success = None  # type: Optional[CMakeBinary]
+
+    # start with the newest version: the result is the oldest version of the last uninterrupted series of working
+    # versions, so the search can stop at the first error
+    versions.reverse()
+
+    # the versions are tested independently, so they can be configured in parallel
+    with tempfile.TemporaryDirectory() as tmpdir, ThreadPoolExecutor(max_workers=jobs) as executor:
+        # every running probe borrows one of the build directories and returns it afterwards
+        build_dirs = Queue()  # type: Queue[Path]
+        for slot in range(jobs):
+            build_dir = Path(tmpdir, str(slot))
+            build_dir.mkdir()
+            build_dirs.put(build_dir)
+
+        def configure(binary: Path) -> ConfigureResult:
+            build_dir = build_dirs.get()
+            try:
+                return try_configure(
+                    binary=binary,
+                    cmake_parameters=cmake_parameters,
+                    build_dir=build_dir,
+                    probe_cache=probe_cache,
+                )
+            finally:
+                build_dirs.put(build_dir)
 
-    return versions[last_success_idx] if last_success_idx is not None else None
+        futures = [executor.submit(configure, cmake_binary.binary) for cmake_binary in versions]
 
+        try:
+            for steps, (cmake_binary, future) in enumerate(zip(versions, futures)):
+                print(
+                    f"[{100.0 * steps / len(versions):3.0f}%] CMake {cmake_binary.version:{longest_version_string}}",
+                    end="",
+                    flush=True,
+                )
 
-def full_search(*, cmake_parameters: List[str], tools_dir: Path, error_output: bool) -> Optional[CMakeBinary]:
-    versions = get_cmake_binaries(tools_dir)  # type: List[CMakeBinary]
-    longest_version_string = max([len(cmake.version) for cmake in versions]) + 1  # type: int
-    last_success_idx = None  # type: Optional[int]
+                result = future.result()  # type: ConfigureResult
+                print_result(result, error_output=error_output)
 
-    for steps, cmake_binary in enumerate(versions):
-        print(
-            "[{progress:3.0f}%] CMake {cmake_version:{longest_version_string}}".format(
-                progress=100.0 * float(steps) / len(versions),
-                cmake_version=cmake_binary.version,
-                longest_version_string=longest_version_string,
-            ),
-            end="",
-            flush=True,
-        )
+                if result.success:
+                    last_success = cmake_binary
+                else:
+                    # older versions cannot change the result anymore
+                    break
+        finally:
+            # after the first error, an exception, or Ctrl-C, the queued probes must not delay the exit
+            for pending_future in futures:
+                pending_future.cancel()
 
-        result = try_configure(binary=cmake_binary.binary, cmake_parameters=cmake_parameters)  # type: ConfigureResult
+    return last_success
 
-        if result.success:
-            print(colored("✔ works", "green"))
-            if not last_success_idx:
-                last_success_idx = steps
-        else:
-            last_success_idx = None
-            print(colored("✘ error", "red"))
-            if error_output:
-                for line in result.stderr.splitlines():
-                    print(colored(f"       {line}", "yellow"))
-            elif result.reason:
-                print(colored(f"       {result.reason}", "yellow"))
 
-    return versions[last_success_idx] if last_success_idx is not None else None
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        message = f"{value} is not a positive number"
+        raise argparse.ArgumentTypeError(message)
+    return number
 
 
 if __name__ == "__main__":
@@ -194,21 +512,42 @@ if __name__ == "__main__":
         action="store_true",
         help="Print the full stderr output in case of an error (default: False)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help="Number of CMake versions to try in parallel (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Reuse results of earlier runs for an unchanged project and environment (default: False)",
+    )
     args = parser.parse_args()
 
+    probe_cache = ProbeCache(Path(args.tools_directory), args.params) if args.cache else None
+
     if args.full_search:
         working_version = full_search(
             cmake_parameters=args.params,
             tools_dir=Path(args.tools_directory),
             error_output=args.error_details,
+            jobs=args.jobs,
+            probe_cache=probe_cache,
         )
     else:
         working_version = binary_search(
             cmake_parameters=args.params,
             tools_dir=Path(args.tools_directory),
             error_output=args.error_details,
+            jobs=args.jobs,
+            probe_cache=probe_cache,
         )
 
+    if probe_cache:
+        probe_cache.save()
+
     if working_version:
         print(
             "[100%] Minimal working version: {cmake} {version}".format(